@@ -1,13 +1,17 @@
 import streamlit as st
-import requests
+import httpx
 import json
-from pathlib import Path
-import os
 
 # Constants
 API_URL = "http://localhost:8000"  # Remove /api suffix
 SUPPORTED_IMAGE_TYPES = ["png", "jpg", "jpeg"]
 SUPPORTED_DOC_TYPES = ["pdf"]
+REQUEST_TIMEOUT = 120  # seconds; model responses can take a while
+
+@st.cache_resource
+def get_client():
+    """Shared HTTP client so connections to the API are kept alive across reruns"""
+    return httpx.Client(base_url=API_URL, timeout=REQUEST_TIMEOUT)
 
 def init_session_state():
     """Initialize session state variables"""
@@ -18,58 +22,42 @@ def init_session_state():
     if 'current_file' not in st.session_state:
         st.session_state.current_file = None
 
-def make_request(endpoint, data, files=None):
-    """Make API request to backend"""
+def stream_tokens(endpoint, **request_kwargs):
+    """Yield response tokens from a streaming (Server-Sent Events) endpoint"""
     try:
-        # Ensure endpoint has /api prefix
-        if not endpoint.startswith('/api/'):
-            endpoint = f"/api/{endpoint.lstrip('/')}"
-            
-        url = f"{API_URL}{endpoint}"
-        
-        print(f"Making request to: {url}")
-        
-        # Always use form data for consistency
-        form_data = {
-            "prompt": data["prompt"],
-            "temperature": str(data["temperature"]),
-            "max_tokens": str(data["max_tokens"])
-        }
-        
-        if data.get("session_id"):
-            form_data["session_id"] = data["session_id"]
-            
-        headers = {
-            'accept': 'application/json'
-        }
-        
-        if files:
-            response = requests.post(
-                url,
-                data=form_data,
-                files=files,
-                headers=headers
-            )
-        else:
-            response = requests.post(
-                url,
-                data=form_data,  # Use form_data instead of json
-                headers=headers
-            )
-        
-        print(f"Request data: {form_data}")
-        print(f"Response status: {response.status_code}")
-        print(f"Response headers: {response.headers}")
-        print(f"Response text: {response.text}")
-        
-        if response.status_code == 200:
-            return response.json()
-        else:
-            st.error(f"Error {response.status_code}: {response.text}")
-            return None
-    except Exception as e:
+        with get_client().stream("POST", endpoint, **request_kwargs) as response:
+            if response.status_code != 200:
+                response.read()
+                st.error(f"Error {response.status_code}: {response.text}")
+                return
+            for line in response.iter_lines():
+                if line.startswith("data: "):
+                    yield json.loads(line[len("data: "):])["token"]
+    except httpx.HTTPError as e:
         st.error(f"Request failed: {str(e)}")
-        return None
+
+def stream_chat(data):
+    """Yield response tokens from the streaming chat endpoint"""
+    payload = {
+        "prompt": data["prompt"],
+        "temperature": data["temperature"],
+        "max_tokens": data["max_tokens"],
+        "session_id": data.get("session_id"),
+        "stream": True
+    }
+    return stream_tokens("/api/chat", json=payload)
+
+def stream_upload(data, files):
+    """Yield response tokens for a question about an uploaded file"""
+    form_data = {
+        "prompt": data["prompt"],
+        "temperature": str(data["temperature"]),
+        "max_tokens": str(data["max_tokens"]),
+        "stream": "true"
+    }
+    if data.get("session_id"):
+        form_data["session_id"] = data["session_id"]
+    return stream_tokens("/api/upload", data=form_data, files=files)
 
 def main():
     st.set_page_config(
@@ -129,24 +117,25 @@ def main():
         # Handle file upload if present
         files = None
         if st.session_state.current_file:
-            files = {"file": st.session_state.current_file}
+            current_file = st.session_state.current_file
+            # Stream the in-memory upload directly instead of copying it out
+            current_file.seek(0)
+            files = {"file": (current_file.name, current_file, current_file.type)}
 
         # Make API request and show response
         with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
-                result = make_request("chat", data, files)
-                
-                if result:
-                    response = result["response"]
-                    st.session_state.session_id = result["session_id"]
-                    
-                    # Update chat history
-                    st.session_state.chat_history.append({
-                        "prompt": prompt,
-                        "response": response
-                    })
-                    
-                    st.write(response)
+            # Tokens are shown as they are generated
+            if files:
+                response = st.write_stream(stream_upload(data, files))
+            else:
+                response = st.write_stream(stream_chat(data))
+
+            if response:
+                # Update chat history
+                st.session_state.chat_history.append({
+                    "prompt": prompt,
+                    "response": response
+                })
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,20 +1,35 @@
-import ollama
+import asyncio
+import mmap
+import pybase64
+from ollama import AsyncClient
 
-with open ('./landscape.jpg', 'rb') as f:
-    
-    response = ollama.chat(
+
+async def analyze_image(client, image_path, prompt):
+    # Pre-encode with SIMD base64 so the client sends the string as-is
+    # and map the file so it is encoded from the page cache without a copy
+    with open(image_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        image_b64 = pybase64.b64encode_as_string(mm)
+    response = await client.chat(
         model='llama3.2-vision',
         messages=[{
             'role': 'user',
-            # 'content': 'What is in this image?',
-            'content': 'What is ML? give in short',
-            'images': [f.read()]
+            'content': prompt,
+            'images': [image_b64]
         }]
     )
+    return response['message']['content']
+
+
+async def main():
+    client = AsyncClient()
+    # Queue as many (image, prompt) pairs as needed; they are sent concurrently
+    tasks = [
+        # analyze_image(client, './landscape.jpg', 'What is in this image?'),
+        analyze_image(client, './landscape.jpg', 'What is ML? give in short'),
+    ]
+    for content in await asyncio.gather(*tasks):
+        print(content)
 
-print(response['message']['content'])
 
-# # Add project root to sys.path to import logger
-# sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-# from logger import get_logger
-    
\ No newline at end of file
+if __name__ == "__main__":
+    asyncio.run(main())
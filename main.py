@@ -1,32 +1,56 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional
-import shutil
+from fastapi.responses import StreamingResponse, ORJSONResponse
+from starlette.concurrency import iterate_in_threadpool
+from pydantic import BaseModel, ConfigDict
+from typing import Optional, Dict
 import os
-from models.model_loader import generate_response
-from models.db_manager import MongoDBManager
+import orjson
+import asyncio
+import hashlib
+from contextlib import asynccontextmanager
+from models.model_loader import generate_response_async, stream_response, VISION_MODEL
+from models.db_manager import AsyncMongoDBManager
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+# Identical chat requests currently being answered, keyed by request_key()
+INFLIGHT: Dict[str, "Inflight"] = {}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Check MongoDB once so an unreachable server doesn't stall every request,
+    # and create the session TTL index even if the image path never builds the
+    # synchronous manager
+    await session_manager.setup()
+    yield
+
 app = FastAPI(
     title="VisiQ-GPT API",
     description="API for processing text, images, and PDFs using LLM models",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Configure CORS
+# Only the Streamlit front-end calls the API; preflights are cached for a day
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=[os.getenv('FRONTEND_ORIGIN', 'http://localhost:8501')],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type", "accept"],
+    max_age=86400,
 )
 
 class QueryParams(BaseModel):
-    model_name: Optional[str] = "llama3.2-vision"
+    model_config = ConfigDict(extra='ignore', str_max_length=8192)
+
+    model_name: Optional[str] = VISION_MODEL
     max_tokens: Optional[int] = 800
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.9
@@ -34,56 +58,164 @@ class QueryParams(BaseModel):
     detailed_response: Optional[bool] = True
 
 class TextQuery(BaseModel):
+    model_config = ConfigDict(extra='ignore', str_max_length=8192)
+
     prompt: str
     session_id: Optional[str] = None
-    model_name: str = "llama3.2-vision"
+    model_name: str = VISION_MODEL
     max_tokens: int = 800
     temperature: float = 0.7
     top_p: float = 0.9
     top_k: int = 40
     detailed_response: bool = True
+    stream: bool = False
 
 class SessionManager:
     def __init__(self):
-        self.db_manager = MongoDBManager()
+        self.db_manager = AsyncMongoDBManager()
+
+    async def setup(self):
+        if await self.db_manager.check_connection():
+            await self.db_manager.create_indexes()
+
+    async def create_session(self):
+        return await self.db_manager.create_session()
 
-    def create_session(self):
-        return self.db_manager.create_session()
+    async def get_session_file(self, session_id):
+        return await self.db_manager.get_session_file(session_id)
 
-    def get_session_file(self, session_id):
-        return self.db_manager.get_session_file(session_id)
+    async def update_session_file(self, session_id, file_path, file_type):
+        return await self.db_manager.update_session_file(session_id, file_path, file_type)
 
-    def update_session_file(self, session_id, file_path, file_type):
-        return self.db_manager.update_session_file(session_id, file_path, file_type)
+    async def get_context(self, session_id):
+        return await self.db_manager.get_session_context(session_id)
 
-    def add_conversation(self, session_id, prompt, response):
-        return self.db_manager.add_conversation_history(session_id, prompt, response)
+    async def add_conversation(self, session_id, prompt, response, context=None):
+        return await self.db_manager.add_conversation_history(session_id, prompt, response, context)
+
+    async def flush(self, session_id, prompt, response, context=None, file_path=None, file_type=None):
+        return await self.db_manager.flush_session(
+            session_id, prompt, response, context, file_path, file_type
+        )
 
 session_manager = SessionManager()
 
+async def stream_events(chunks, on_complete):
+    """Relay model output as Server-Sent Events, then hand the full response to on_complete"""
+    tokens = []
+    new_context = None
+    # The Ollama stream is read with blocking I/O, so iterate it off the loop
+    async for chunk in iterate_in_threadpool(chunks):
+        token = chunk.get("response", "")
+        done = chunk.get("done", False)
+        tokens.append(token)
+        if done:
+            new_context = chunk.get("context")
+        yield b"data: " + orjson.dumps({'token': token, 'done': done}) + b"\n\n"
+
+    await on_complete("".join(tokens), new_context)
+
+def stream_chat_events(query: TextQuery, context, **file_args):
+    """Stream a chat turn, optionally about a session file, and save it once complete"""
+    chunks = stream_response(
+        prompt=query.prompt,
+        model_name=query.model_name,
+        max_tokens=query.max_tokens,
+        temperature=query.temperature,
+        top_p=query.top_p,
+        top_k=query.top_k,
+        detailed_response=query.detailed_response,
+        context=context,
+        **file_args
+    )
+
+    async def save_turn(response, new_context):
+        if query.session_id:
+            await session_manager.add_conversation(query.session_id, query.prompt, response, new_context)
+
+    return stream_events(chunks, save_turn)
+
+def request_key(query: TextQuery) -> str:
+    """Key identifying chat requests that would produce the same answer"""
+    fields = [
+        query.prompt, query.session_id, query.model_name, query.max_tokens,
+        query.temperature, query.top_p, query.top_k, query.detailed_response
+    ]
+    return hashlib.blake2b(orjson.dumps(fields), digest_size=16).hexdigest()
+
+class Inflight:
+    """A shared computation and how many callers are still waiting for it"""
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+async def coalesce(key: str, compute):
+    """Run compute() once for concurrent callers sharing the same key.
+
+    The first caller starts the work as its own task; callers arriving while it
+    is in flight await the same result. A caller that disconnects only stops
+    waiting, and the work is cancelled once nobody is left. No lock is needed
+    since the map is only touched between awaits on the event loop thread.
+    """
+    inflight = INFLIGHT.get(key)
+    if inflight is None:
+        inflight = INFLIGHT[key] = Inflight(asyncio.ensure_future(compute()))
+        inflight.task.add_done_callback(
+            lambda _: INFLIGHT.pop(key) if INFLIGHT.get(key) is inflight else None
+        )
+
+    inflight.waiters += 1
+    try:
+        return await asyncio.shield(inflight.task)
+    finally:
+        inflight.waiters -= 1
+        if not inflight.waiters and not inflight.task.done():
+            inflight.task.cancel()
+
+async def answer_chat(query: TextQuery) -> str:
+    """Generate a chat answer and record it in the session"""
+    context = await session_manager.get_context(query.session_id) if query.session_id else None
+    response, context = await generate_response_async(
+        prompt=query.prompt,
+        model_name=query.model_name,
+        max_tokens=query.max_tokens,
+        temperature=query.temperature,
+        top_p=query.top_p,
+        top_k=query.top_k,
+        detailed_response=query.detailed_response,
+        context=context,
+        return_context=True
+    )
+
+    if query.session_id:
+        await session_manager.add_conversation(query.session_id, query.prompt, response, context)
+    return response
+
 @app.post("/api/session")
 async def create_session():
     """Create a new chat session"""
-    session_id = session_manager.create_session()
+    session_id = await session_manager.create_session()
     return {"session_id": session_id}
 
 # New endpoint for direct text queries
 @app.post("/api/chat")
 async def chat(query: TextQuery):
-    """Endpoint for direct text queries without file upload"""
+    """Endpoint for direct text queries without file upload.
+
+    Set ``stream`` to receive the response as Server-Sent Events.
+    """
     try:
-        response = generate_response(
-            prompt=query.prompt,
-            model_name=query.model_name,
-            max_tokens=query.max_tokens,
-            temperature=query.temperature,
-            top_p=query.top_p,
-            top_k=query.top_k,
-            detailed_response=query.detailed_response
-        )
+        if query.stream:
+            context = await session_manager.get_context(query.session_id) if query.session_id else None
+            return StreamingResponse(
+                stream_chat_events(query, context),
+                media_type="text/event-stream"
+            )
 
-        if query.session_id:
-            session_manager.add_conversation(query.session_id, query.prompt, response)
+        # Concurrent identical requests (e.g. Streamlit reruns) share one inference
+        response = await coalesce(request_key(query), lambda: answer_chat(query))
 
         return {"status": "success", "response": response}
     except Exception as e:
@@ -99,15 +231,20 @@ async def upload_and_query(
     file: UploadFile = File(...),
     prompt: str = Form(...),
     session_id: Optional[str] = Form(None),
-    model_name: str = Form("llama3.2-vision"),
+    model_name: str = Form(VISION_MODEL),
     max_tokens: int = Form(800),
     temperature: float = Form(0.7),
     top_p: float = Form(0.9),
     top_k: int = Form(40),
-    detailed_response: bool = Form(True)
+    detailed_response: bool = Form(True),
+    stream: bool = Form(False)
 ):
-    """Endpoint for file upload and query"""
+    """Endpoint for file upload and query.
+
+    Set ``stream`` to receive the response as Server-Sent Events.
+    """
     temp_file_path = None
+    streaming = False
     try:
         params = {
             "model_name": model_name,
@@ -118,32 +255,44 @@ async def upload_and_query(
             "detailed_response": detailed_response
         }
 
-        # Save uploaded file
+        # Stream uploaded file to disk chunk by chunk; sessions re-query it by path
         temp_file_path = f"temp_{file.filename}"
         with open(temp_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                buffer.write(chunk)
 
-        # Update session with new file if session exists
-        if session_id:
-            file_type = 'pdf' if file.filename.lower().endswith('.pdf') else 'image'
-            session_manager.update_session_file(session_id, temp_file_path, file_type)
+        file_type = 'pdf' if file.filename.lower().endswith('.pdf') else 'image'  # Assume image
+        file_args = {f"{file_type}_path": temp_file_path}
+
+        if stream:
+            async def save_turn(response, context):
+                # Attach the new file and record the turn in one session write
+                if session_id:
+                    await session_manager.flush(session_id, prompt, response, context, temp_file_path, file_type)
+
+            async def events():
+                try:
+                    async for event in stream_events(stream_response(prompt=prompt, **file_args, **params), save_turn):
+                        yield event
+                finally:
+                    if not session_id and os.path.exists(temp_file_path):
+                        os.remove(temp_file_path)
+
+            # The file is removed once the stream ends, not when this handler returns
+            streaming = True
+            return StreamingResponse(events(), media_type="text/event-stream")
 
         # Process file
-        if file.filename.lower().endswith('.pdf'):
-            response = generate_response(
-                prompt=prompt,
-                pdf_path=temp_file_path,
-                **params
-            )
-        else:  # Assume image
-            response = generate_response(
-                prompt=prompt,
-                image_path=temp_file_path,
-                **params
-            )
+        response, context = await generate_response_async(
+            prompt=prompt,
+            return_context=True,
+            **file_args,
+            **params
+        )
 
+        # Attach the new file and record the turn in one session write
         if session_id:
-            session_manager.add_conversation(session_id, prompt, response)
+            await session_manager.flush(session_id, prompt, response, context, temp_file_path, file_type)
 
         return {"status": "success", "response": response}
 
@@ -154,44 +303,47 @@ async def upload_and_query(
             detail={"status": "error", "message": str(e)}
         )
     finally:
-        if temp_file_path and os.path.exists(temp_file_path) and not session_id:
+        if temp_file_path and os.path.exists(temp_file_path) and not session_id and not streaming:
             os.remove(temp_file_path)
 
 # Modified session query endpoint
 @app.post("/api/session/query")
 async def session_query(query: TextQuery):
-    """Endpoint for querying within an existing session"""
+    """Endpoint for querying within an existing session.
+
+    Set ``stream`` to receive the response as Server-Sent Events.
+    """
     try:
         if not query.session_id:
             raise HTTPException(status_code=400, detail="Session ID is required")
 
-        session_file = session_manager.get_session_file(query.session_id)
+        session_file = await session_manager.get_session_file(query.session_id)
         if not session_file:
             return await chat(query)
 
-        params = {
-            "model_name": query.model_name,
-            "max_tokens": query.max_tokens,
-            "temperature": query.temperature,
-            "top_p": query.top_p,
-            "top_k": query.top_k,
-            "detailed_response": query.detailed_response
-        }
+        file_type = 'pdf' if session_file['file_type'] == 'pdf' else 'image'
+        file_args = {f"{file_type}_path": session_file['file_path']}
 
-        if session_file['file_type'] == 'pdf':
-            response = generate_response(
-                prompt=query.prompt,
-                pdf_path=session_file['file_path'],
-                **params
-            )
-        else:
-            response = generate_response(
-                prompt=query.prompt,
-                image_path=session_file['file_path'],
-                **params
+        if query.stream:
+            return StreamingResponse(
+                stream_chat_events(query, session_file.get('context'), **file_args),
+                media_type="text/event-stream"
             )
 
-        session_manager.add_conversation(query.session_id, query.prompt, response)
+        response, context = await generate_response_async(
+            prompt=query.prompt,
+            model_name=query.model_name,
+            max_tokens=query.max_tokens,
+            temperature=query.temperature,
+            top_p=query.top_p,
+            top_k=query.top_k,
+            detailed_response=query.detailed_response,
+            context=session_file.get('context'),
+            return_context=True,
+            **file_args
+        )
+
+        await session_manager.add_conversation(query.session_id, query.prompt, response, context)
         return {"status": "success", "response": response}
 
     except Exception as e:
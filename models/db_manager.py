@@ -1,15 +1,129 @@
 import os
+import time
+import functools
 from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import AutoReconnect, ServerSelectionTimeoutError
+from pymongo.write_concern import WriteConcern
 from typing import Optional, Dict, List
 import json
 from datetime import datetime
 import numpy as np
 from urllib.parse import quote_plus
 from utils.logger import get_logger
-from bson import ObjectId
+from bson import ObjectId, Binary
 
 logger = get_logger(__name__)
 
+SESSION_FILE_PROJECTION = {'current_file': 1, 'file_type': 1, 'context': 1}
+SESSION_TTL_SECONDS = 24 * 60 * 60  # Drop sessions idle for a day
+# Storage precision for embeddings; float16 halves document size at a small recall cost
+EMBEDDING_STORE_DTYPE = np.dtype(os.getenv('EMBEDDING_STORE_DTYPE', 'float32'))
+
+def _requires_connection(default=None):
+    """Skip the operation when not connected and log connection failures.
+
+    Relies on MongoClient's own server monitoring instead of pinging the
+    server before every operation. ``default`` may be a callable factory.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            try:
+                if self.db is not None:
+                    return func(self, *args, **kwargs)
+            except (AutoReconnect, ServerSelectionTimeoutError) as e:
+                logger.error(f"MongoDB {func.__name__} failed: {e}")
+            return default() if callable(default) else default
+        return wrapper
+    return decorator
+
+def _pack_embeddings(embeddings) -> Dict:
+    """Pack embeddings as raw bytes plus shape and dtype for compact BSON storage"""
+    if embeddings is None:
+        return {'embeddings': None, 'shape': None, 'dtype': None}
+    array = np.ascontiguousarray(embeddings, dtype=EMBEDDING_STORE_DTYPE)
+    return {
+        'embeddings': Binary(array.tobytes()),
+        'shape': list(array.shape),
+        'dtype': array.dtype.name
+    }
+
+def _unpack_embeddings(document: Optional[Dict]) -> Optional[Dict]:
+    """Restore embeddings stored by _pack_embeddings as a float32 numpy array"""
+    if document and isinstance(document.get('embeddings'), bytes):
+        # Documents written before dtype was recorded hold float32
+        dtype = document.get('dtype') or 'float32'
+        document['embeddings'] = np.frombuffer(
+            document['embeddings'], dtype=dtype
+        ).reshape(document['shape']).astype(np.float32, copy=False)
+    return document
+
+def _requires_async_connection(default=None):
+    """Async counterpart of _requires_connection for AsyncMongoDBManager"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            try:
+                if self.db is not None:
+                    return await func(self, *args, **kwargs)
+            except (AutoReconnect, ServerSelectionTimeoutError) as e:
+                logger.error(f"MongoDB {func.__name__} failed: {e}")
+            return default() if callable(default) else default
+        return wrapper
+    return decorator
+
+def _new_session() -> Dict:
+    """Build an empty chat session document"""
+    now = datetime.now()
+    return {
+        'session_id': str(ObjectId()),
+        'created_at': now,
+        'last_activity': now,
+        'history': [],
+        'current_file': None,
+        'file_type': None,
+        'context': None  # Ollama token context from the last turn
+    }
+
+def _session_turn_update(prompt: str, response: str,
+                         context: Optional[List[int]] = None,
+                         file_path: Optional[str] = None,
+                         file_type: Optional[str] = None) -> Dict:
+    """Build the update that records a chat turn and optionally a new file"""
+    # last_activity stays a BSON date because the session TTL index needs one
+    updates = {'last_activity': datetime.now()}
+    if file_path is not None:
+        updates['current_file'] = file_path
+        updates['file_type'] = file_type
+        updates['context'] = None  # New file invalidates the cached prefix
+    if context is not None:
+        updates['context'] = context
+
+    return {
+        '$push': {
+            'history': {
+                '$each': [{
+                    'prompt': prompt,
+                    'response': response,
+                    'ts_ns': time.time_ns()
+                }],
+                '$slice': -5  # Keep only last 5 conversations
+            }
+        },
+        '$set': updates
+    }
+
+def _session_file(session: Optional[Dict]) -> Optional[Dict]:
+    """Extract the current file and saved context from a session document"""
+    if session and session.get('current_file'):
+        return {
+            'file_path': session['current_file'],
+            'file_type': session['file_type'],
+            'context': session.get('context')
+        }
+    return None
+
 class MongoDBManager:
     _instance = None
     _connection_string = None
@@ -35,6 +149,7 @@ class MongoDBManager:
         if not hasattr(self, 'client'):
             self.client = None
             self.db = None
+            self.chat_sessions = None
             # Try custom connection first, then build default
             self._connection_string = os.getenv('MONGODB_URI', 
                 self._build_connection_string(
@@ -61,17 +176,31 @@ class MongoDBManager:
             logger.info("Attempting to connect to MongoDB...")
             self.client = MongoClient(
                 self._connection_string,
-                serverSelectionTimeoutMS=5000  # 5 second timeout
+                serverSelectionTimeoutMS=5000,  # 5 second timeout
+                maxPoolSize=50,
+                compressors='zstd'
             )
             # Test connection
             self.client.admin.command('ping')
             self.db = self.client.visiq_embeddings
+            # Chat turns don't need journaled writes; acknowledge from memory
+            self.chat_sessions = self.db.get_collection(
+                'chat_sessions', write_concern=WriteConcern(w=1, j=False)
+            )
             
             # Create indexes for faster queries
             self.db.image_embeddings.create_index([("image_path", 1)], background=True)
             self.db.pdf_embeddings.create_index([("pdf_path", 1)], background=True)
-            self.db.image_embeddings.create_index([("timestamp", -1)], background=True)
-            self.db.pdf_embeddings.create_index([("timestamp", -1)], background=True)
+            self.db.image_embeddings.create_index([("ts_ns", -1)], background=True)
+            self.db.pdf_embeddings.create_index([("ts_ns", -1)], background=True)
+            self.db.image_embeddings.create_index(
+                [("sha256", 1)], unique=True, background=True,
+                partialFilterExpression={"sha256": {"$type": "string"}}
+            )
+            # Let MongoDB expire abandoned chat sessions on its own
+            self.chat_sessions.create_index(
+                [("last_activity", 1)], expireAfterSeconds=SESSION_TTL_SECONDS, background=True
+            )
             
             logger.info("Successfully connected to MongoDB and created indexes")
             return True
@@ -79,36 +208,19 @@ class MongoDBManager:
             logger.error(f"Error connecting to MongoDB: {e}")
             self.client = None
             self.db = None
+            self.chat_sessions = None
             return False
 
-    def _check_connection(self) -> bool:
-        """Check if database connection is active"""
-        try:
-            if self.client is None or self.db is None:
-                return False
-            # Test connection is alive with timeout
-            self.client.admin.command('ping', serverSelectionTimeoutMS=2000)
-            return True
-        except Exception as e:
-            logger.error(f"MongoDB connection check failed: {e}")
-            return False
-
+    @_requires_connection()
     def store_pdf_embeddings(self, pdf_path: str, embeddings_data: Dict):
         """Store PDF embeddings in MongoDB"""
-        if not self._check_connection():
-            return None
-
         collection = self.db.pdf_embeddings
         
-        # Convert numpy arrays to lists if present
-        if isinstance(embeddings_data.get('embeddings'), np.ndarray):
-            embeddings_data['embeddings'] = embeddings_data['embeddings'].tolist()
-
         document = {
             'pdf_path': pdf_path,
-            'embeddings': embeddings_data.get('embeddings'),
+            **_pack_embeddings(embeddings_data.get('embeddings')),
             'metadata': embeddings_data.get('metadata', {}),
-            'timestamp': datetime.now(),
+            'ts_ns': time.time_ns(),
             'chunks': embeddings_data.get('chunks', [])
         }
 
@@ -118,119 +230,237 @@ class MongoDBManager:
             upsert=True
         )
 
+    @_requires_connection()
     def store_image_embeddings(self, image_path: str, image_data: Dict):
         """Store image embeddings and analysis in MongoDB"""
-        if not self._check_connection():
-            return None
-
         collection = self.db.image_embeddings
         
-        # Convert numpy arrays to lists if present
-        if isinstance(image_data.get('embeddings'), np.ndarray):
-            image_data['embeddings'] = image_data['embeddings'].tolist()
-
+        sha256 = image_data.get('sha256')
         document = {
             'image_path': image_path,
             'base64_image': image_data.get('base64_image'),
             'vision_analysis': image_data.get('vision_analysis'),
-            'embeddings': image_data.get('embeddings'),
-            'timestamp': datetime.now()
+            **_pack_embeddings(image_data.get('embeddings')),
+            'ts_ns': time.time_ns()
         }
 
+        # Content hash identifies the image regardless of where it was uploaded
+        if sha256:
+            document['sha256'] = sha256
+        key = {'sha256': sha256} if sha256 else {'image_path': image_path}
         return collection.update_one(
-            {'image_path': image_path},
+            key,
             {'$set': document},
             upsert=True
         )
 
+    @_requires_connection()
     def get_pdf_embeddings(self, pdf_path: str) -> Optional[Dict]:
         """Retrieve PDF embeddings from MongoDB"""
-        if not self._check_connection():
-            return None
-
         result = self.db.pdf_embeddings.find_one({'pdf_path': pdf_path})
-        return result
+        return _unpack_embeddings(result)
 
+    @_requires_connection()
     def get_image_embeddings(self, image_path: str) -> Optional[Dict]:
         """Retrieve image embeddings from MongoDB"""
-        if not self._check_connection():
-            return None
-
         result = self.db.image_embeddings.find_one({'image_path': image_path})
-        return result
+        return _unpack_embeddings(result)
+
+    @_requires_connection()
+    def get_image_by_hash(self, sha256: str) -> Optional[Dict]:
+        """Retrieve a stored image analysis by the SHA256 of the image contents"""
+        result = self.db.image_embeddings.find_one({'sha256': sha256})
+        return _unpack_embeddings(result)
 
+    @_requires_connection()
     def create_session(self) -> str:
         """Create a new chat session and return session ID"""
-        if not self._check_connection():
-            return None
-            
-        session = {
-            'session_id': str(ObjectId()),
-            'created_at': datetime.now(),
-            'last_activity': datetime.now(),
-            'history': [],
-            'current_file': None,
-            'file_type': None
-        }
-        
-        self.db.chat_sessions.insert_one(session)
+        session = _new_session()
+        self.chat_sessions.insert_one(session)
         return session['session_id']
 
+    @_requires_connection()
     def update_session_file(self, session_id: str, file_path: str, file_type: str):
         """Update the file associated with a session"""
-        if not self._check_connection():
-            return None
-            
-        self.db.chat_sessions.update_one(
+        self.chat_sessions.update_one(
             {'session_id': session_id},
             {
                 '$set': {
                     'last_activity': datetime.now(),
                     'current_file': file_path,
-                    'file_type': file_type
+                    'file_type': file_type,
+                    'context': None  # New file invalidates the cached prefix
                 }
             }
         )
 
+    @_requires_connection()
     def get_session_file(self, session_id: str) -> dict:
-        """Get the last file used in the session"""
-        if not self._check_connection():
-            return None
-            
-        session = self.db.chat_sessions.find_one({'session_id': session_id})
-        if session and session.get('current_file'):
-            return {
-                'file_path': session['current_file'],
-                'file_type': session['file_type']
-            }
-        return None
+        """Get the last file used in the session along with its saved context"""
+        session = self.chat_sessions.find_one(
+            {'session_id': session_id}, SESSION_FILE_PROJECTION
+        )
+        return _session_file(session)
 
-    def add_conversation_history(self, session_id: str, prompt: str, response: str):
+    def add_conversation_history(self, session_id: str, prompt: str, response: str,
+                                 context: Optional[List[int]] = None):
         """Add a conversation to the session history, maintaining only last 5"""
-        if not self._check_connection():
-            return None
-            
-        self.db.chat_sessions.update_one(
+        return self.flush_session(session_id, prompt, response, context)
+
+    @_requires_connection()
+    def flush_session(self, session_id: str, prompt: str, response: str,
+                      context: Optional[List[int]] = None,
+                      file_path: Optional[str] = None,
+                      file_type: Optional[str] = None):
+        """Record a chat turn, and optionally the file it used, in a single write"""
+        return self.chat_sessions.update_one(
+            {'session_id': session_id},
+            _session_turn_update(prompt, response, context, file_path, file_type)
+        )
+
+    @_requires_connection(default=list)
+    def get_conversation_history(self, session_id: str):
+        """Get conversation history for a session"""
+        session = self.chat_sessions.find_one({'session_id': session_id})
+        return session.get('history', []) if session else []
+
+    @_requires_connection()
+    def get_session_context(self, session_id: str) -> Optional[List[int]]:
+        """Get the Ollama context tokens saved from the session's last turn"""
+        session = self.chat_sessions.find_one(
+            {'session_id': session_id}, {'context': 1}
+        )
+        return session.get('context') if session else None
+
+
+class AsyncMongoDBManager:
+    """Non-blocking session store for async callers such as the FastAPI handlers.
+
+    Mirrors the chat session methods of MongoDBManager using motor, so session
+    reads and writes yield to the event loop instead of blocking it.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(AsyncMongoDBManager, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'client'):
+            self.client = None
+            self.db = None
+            self.chat_sessions = None
+            self._connection_string = os.getenv('MONGODB_URI',
+                MongoDBManager._build_connection_string(
+                    MongoDBManager.DEFAULT_USERNAME,
+                    MongoDBManager.DEFAULT_PASSWORD,
+                    MongoDBManager.DEFAULT_CLUSTER
+                ))
+            self.connect()
+
+    def connect(self):
+        """Create the motor client; check_connection() verifies it on startup"""
+        try:
+            self.client = AsyncIOMotorClient(
+                self._connection_string,
+                serverSelectionTimeoutMS=5000,
+                maxPoolSize=50,
+                compressors='zstd'
+            )
+            self.db = self.client.visiq_embeddings
+            self.chat_sessions = self.db.get_collection(
+                'chat_sessions', write_concern=WriteConcern(w=1, j=False)
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Error creating async MongoDB client: {e}")
+            self.client = None
+            self.db = None
+            self.chat_sessions = None
+            return False
+
+    async def check_connection(self) -> bool:
+        """Ping the server once, disabling session storage if it is unreachable.
+
+        Without this every session operation would wait out the server
+        selection timeout before failing.
+        """
+        if self.client is None:
+            return False
+        try:
+            await self.client.admin.command('ping')
+            logger.info("Successfully connected to MongoDB")
+            return True
+        except Exception as e:
+            logger.error(f"Error connecting to MongoDB: {e}")
+            self.db = None
+            self.chat_sessions = None
+            return False
+
+    @_requires_async_connection()
+    async def create_indexes(self):
+        """Create the chat session indexes, including the idle-session TTL"""
+        await self.chat_sessions.create_index(
+            [("last_activity", 1)], expireAfterSeconds=SESSION_TTL_SECONDS, background=True
+        )
+
+    @_requires_async_connection()
+    async def create_session(self) -> str:
+        """Create a new chat session and return session ID"""
+        session = _new_session()
+        await self.chat_sessions.insert_one(session)
+        return session['session_id']
+
+    @_requires_async_connection()
+    async def update_session_file(self, session_id: str, file_path: str, file_type: str):
+        """Update the file associated with a session"""
+        await self.chat_sessions.update_one(
             {'session_id': session_id},
             {
-                '$push': {
-                    'history': {
-                        '$each': [{
-                            'prompt': prompt,
-                            'response': response,
-                            'timestamp': datetime.now()
-                        }],
-                        '$slice': -5  # Keep only last 5 conversations
-                    }
-                },
-                '$set': {'last_activity': datetime.now()}
+                '$set': {
+                    'last_activity': datetime.now(),
+                    'current_file': file_path,
+                    'file_type': file_type,
+                    'context': None
+                }
             }
         )
 
-    def get_conversation_history(self, session_id: str):
+    @_requires_async_connection()
+    async def get_session_file(self, session_id: str) -> dict:
+        """Get the last file used in the session along with its saved context"""
+        session = await self.chat_sessions.find_one(
+            {'session_id': session_id}, SESSION_FILE_PROJECTION
+        )
+        return _session_file(session)
+
+    async def add_conversation_history(self, session_id: str, prompt: str, response: str,
+                                       context: Optional[List[int]] = None):
+        """Add a conversation to the session history, maintaining only last 5"""
+        return await self.flush_session(session_id, prompt, response, context)
+
+    @_requires_async_connection()
+    async def flush_session(self, session_id: str, prompt: str, response: str,
+                            context: Optional[List[int]] = None,
+                            file_path: Optional[str] = None,
+                            file_type: Optional[str] = None):
+        """Record a chat turn, and optionally the file it used, in a single write"""
+        return await self.chat_sessions.update_one(
+            {'session_id': session_id},
+            _session_turn_update(prompt, response, context, file_path, file_type)
+        )
+
+    @_requires_async_connection(default=list)
+    async def get_conversation_history(self, session_id: str):
         """Get conversation history for a session"""
-        if not self._check_connection():
-            return []
-            
-        session = self.db.chat_sessions.find_one({'session_id': session_id})
-        return session.get('history', []) if session else []
\ No newline at end of file
+        session = await self.chat_sessions.find_one({'session_id': session_id})
+        return session.get('history', []) if session else []
+
+    @_requires_async_connection()
+    async def get_session_context(self, session_id: str) -> Optional[List[int]]:
+        """Get the Ollama context tokens saved from the session's last turn"""
+        session = await self.chat_sessions.find_one(
+            {'session_id': session_id}, {'context': 1}
+        )
+        return session.get('context') if session else None
\ No newline at end of file
@@ -1,66 +1,485 @@
 import chromadb
-from chromadb.utils.embedding_functions import OllamaEmbeddingFunction
-from langchain_community.document_loaders import PyMuPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+import fitz  # PyMuPDF
 from sentence_transformers import CrossEncoder
-from typing import Tuple, List
+from typing import Tuple, List, Dict, Iterator, Optional
+import functools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import multiprocessing
+import numpy as np
+import orjson
 import os
+import random
+import sqlite3
+import threading
+import time
+import torch
+from models.pdf_extract import extract_page_range
+from utils.http_client import post_json
+from utils.logger import get_logger
 
-class EmbeddingsProcessor:
-    def __init__(self):
-        ollama_ef = OllamaEmbeddingFunction(
-            url="http://localhost:11434/api/embeddings",
-            model_name="nomic-embed-text:latest"
-        )
-        self.chroma_client = chromadb.PersistentClient(path="./demo-rag-chroma")
-        self.collection = self.chroma_client.get_or_create_collection(
-            name="rag_app",
-            embedding_function=ollama_ef,
-            metadata={"hnsw:space": "cosine"}
-        )
+logger = get_logger(__name__)
 
-    def process_pdf(self, pdf_path: str) -> Tuple[str, None]:
-        loader = PyMuPDFLoader(pdf_path)
-        docs = loader.load()
-        
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=400,
-            chunk_overlap=100,
-            separators=["\n\n", "\n", ".", "?", "!", " ", ""]
+CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+RERANK_BATCH_SIZE = 32
+RERANK_TOP_K = 3
+EMBEDDING_MODEL = "nomic-embed-text:latest"
+# nomic-embed-text v1.5 is Matryoshka-trained, so vectors can be cut to fewer
+# dimensions (e.g. 256) at some recall cost; 768 keeps them whole
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "768"))
+# Vectors of different sizes cannot share a collection
+COLLECTION_NAME = "rag_app" if EMBEDDING_DIMENSIONS >= 768 else f"rag_app_{EMBEDDING_DIMENSIONS}"
+OLLAMA_EMBED_URL = "http://localhost:11434/api/embed"
+OLLAMA_LEGACY_EMBED_URL = "http://localhost:11434/api/embeddings"
+EMBED_BATCH_SIZE = 128  # Texts sent per /api/embed request
+EMBED_CONCURRENCY = 4  # Upsert batches embedded at once while indexing a PDF
+EMBED_MAX_RETRIES = 5
+EMBEDDING_CACHE_PATH = "./embedding_cache.sqlite3"
+# host[:port] of a standalone Chroma server (`chroma run --path ./demo-rag-chroma
+# --port 8001`); unset keeps the embedded store inside the API process
+CHROMA_HOST = os.getenv("CHROMA_HOST")
+CHROMA_DEFAULT_PORT = 8001  # Chroma's own default, 8000, is where this API listens
+HNSW_BATCH_SIZE = 250  # Vectors buffered before they are added to the HNSW graph
+UPSERT_BATCH_SIZE = 250  # Chroma performs best with 100-250 documents per write
+PDF_PARALLEL_MIN_PAGES = 200  # Documents shorter than this are extracted inline
+PDF_PAGES_PER_TASK = 50
+HASH_CHUNK_SIZE = 1024 * 1024  # 1 MB
+CHUNK_SIZE = 400
+CHUNK_OVERLAP = 100
+# Preferred chunk boundaries, strongest first: paragraph, line, sentence, word
+CHUNK_SEPARATORS = ("\n\n", "\n", ".", "?", "!", " ")
+
+
+def detect_device() -> str:
+    """Pick the fastest available torch device."""
+    if torch.cuda.is_available():
+        return 'cuda'
+    if torch.backends.mps.is_available():
+        return 'mps'
+    return 'cpu'
+
+
+_encoder_lock = threading.Lock()
+
+
+def _load_cross_encoder() -> CrossEncoder:
+    """Return the shared re-ranking model, loading it on first use.
+
+    Requests run in executor threads, so the lock keeps two first queries from
+    loading the model twice.
+    """
+    with _encoder_lock:
+        return _load_cross_encoder_once()
+
+
+@functools.lru_cache(maxsize=1)
+def _load_cross_encoder_once() -> CrossEncoder:
+    device = detect_device()
+    encoder = CrossEncoder(CROSS_ENCODER_MODEL, device=device, max_length=256)
+    if device == 'cuda':
+        encoder.model.half()  # fp16 halves memory traffic and uses tensor cores
+        try:
+            # Fuse the transformer kernels; dynamic shapes avoid a recompile per query length
+            encoder.model = torch.compile(encoder.model, dynamic=True)
+            encoder.predict([("warm up", "warm up")], batch_size=1)
+        except Exception as e:
+            logger.warning(f"torch.compile unavailable, re-ranking in eager mode: {e}")
+            encoder.model = getattr(encoder.model, "_orig_mod", encoder.model)
+    return encoder
+
+
+def configure_hnsw_params(vector_count: int) -> Dict[str, int]:
+    """Pick HNSW graph parameters suited to the collection size.
+
+    Larger collections need a denser graph and wider search to keep recall up.
+    """
+    if vector_count < 100_000:
+        return {"hnsw:M": 16, "hnsw:construction_ef": 128, "hnsw:search_ef": 64}
+    if vector_count < 1_000_000:
+        return {"hnsw:M": 24, "hnsw:construction_ef": 200, "hnsw:search_ef": 100}
+    return {"hnsw:M": 32, "hnsw:construction_ef": 256, "hnsw:search_ef": 128}
+
+
+def split_text(text: str, chunk_size: int = CHUNK_SIZE,
+               chunk_overlap: int = CHUNK_OVERLAP) -> List[str]:
+    """Split text into overlapping chunks of at most chunk_size characters.
+
+    Each chunk ends at the strongest separator in its window, found with
+    str.rfind so the scanning happens in C rather than in Python regex code.
+    """
+    chunks = []
+    start, length = 0, len(text)
+    while start < length:
+        end = min(start + chunk_size, length)
+        if end < length:
+            for separator in CHUNK_SEPARATORS:
+                # Cut past the overlap so the next chunk always moves forward
+                cut = text.rfind(separator, start + chunk_overlap + 1, end)
+                if cut != -1:
+                    end = cut + len(separator)
+                    break
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= length:
+            break
+        # Start the overlap on a word boundary
+        space = text.find(" ", end - chunk_overlap, end)
+        start = space + 1 if space != -1 else end - chunk_overlap
+    return chunks
+
+
+def _file_sha256(path: str) -> str:
+    with open(path, "rb") as file:
+        # file_digest (Python 3.11+) hashes in OpenSSL with the GIL released
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(file, "sha256").hexdigest()
+        digest = hashlib.sha256()
+        for block in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(block)
+        return digest.hexdigest()
+
+
+def _select_pdf_workers(page_count: int) -> int:
+    """Pick how many processes extract a PDF of this size; 0 means inline.
+
+    Starting workers costs more than MuPDF takes on small documents, so only
+    long ones are split across processes.
+    """
+    if page_count < PDF_PARALLEL_MIN_PAGES:
+        return 0
+    return min(os.cpu_count() or 1, 4 if page_count < 1000 else 8)
+
+
+@functools.lru_cache(maxsize=1)
+def _pdf_mp_context():
+    """Start method for extraction workers.
+
+    Forking this process would copy its generation, embedding, motor and torch
+    threads into every worker. Workers are instead forked from a server that
+    preloads models.pdf_extract, or spawned where there is no fork server
+    (Windows). Both still re-import the launching script as __mp_main__, so
+    the API must be started with `uvicorn main:app`; under `python main.py`
+    every worker would import the full model stack again.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["models.pdf_extract"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+def iter_pdf_pages(pdf_path: str) -> Iterator[Tuple[str, Dict]]:
+    """Yield the text of each page with its metadata, one page at a time.
+
+    Reads straight from MuPDF rather than through LangChain's loader. Long
+    documents are extracted by worker processes a range of pages at a time,
+    with only a few ranges in flight so memory stays bounded.
+    """
+    with fitz.open(pdf_path) as pdf:
+        total_pages = pdf.page_count
+        workers = _select_pdf_workers(total_pages)
+        if not workers:
+            for page in pdf:
+                yield page.get_text(), {"source": pdf_path, "page": page.number, "total_pages": total_pages}
+            return
+
+    def collect(pending):
+        first, future = pending.popleft()
+        for offset, text in enumerate(future.result()):
+            yield text, {"source": pdf_path, "page": first + offset, "total_pages": total_pages}
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=_pdf_mp_context()) as executor:
+        pending = deque()
+        for start in range(0, total_pages, PDF_PAGES_PER_TASK):
+            stop = min(start + PDF_PAGES_PER_TASK, total_pages)
+            pending.append((start, executor.submit(extract_page_range, pdf_path, start, stop)))
+            if len(pending) > workers * 2:
+                yield from collect(pending)
+        while pending:
+            yield from collect(pending)
+
+
+class EmbeddingCache:
+    """On-disk map from chunk text to its embedding, so text that was embedded
+    once (in any document) is not sent to Ollama again."""
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (hash BLOB PRIMARY KEY, embedding BLOB)"
         )
-        splits = text_splitter.split_documents(docs)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model_name: str, text: str) -> bytes:
+        return hashlib.blake2b(f"{model_name}\0{text}".encode(), digest_size=16).digest()
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, List[float]]:
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):  # Stay under SQLite's parameter limit
+                part = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT hash, embedding FROM embeddings WHERE hash IN ({','.join('?' * len(part))})",
+                    part
+                )
+                found.update(
+                    (bytes(key), np.frombuffer(blob, dtype=np.float32).tolist()) for key, blob in rows
+                )
+        return found
+
+    def put_many(self, items: List[Tuple[bytes, List[float]]]):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings VALUES (?, ?)",
+                [(key, np.asarray(embedding, dtype=np.float32).tobytes()) for key, embedding in items]
+            )
+
+
+@functools.lru_cache(maxsize=1)
+def _embedding_cache() -> EmbeddingCache:
+    return EmbeddingCache()
+
+
+class OllamaBatchEmbeddingFunction(EmbeddingFunction):
+    """Chroma embedding function that embeds many texts per Ollama request.
+
+    With ``use_cache`` the vectors are kept in the on-disk EmbeddingCache. That
+    suits document chunks; one-off query texts would only grow the cache and
+    add a write to every request.
+    """
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL, batch_size: int = EMBED_BATCH_SIZE,
+                 dimensions: int = EMBEDDING_DIMENSIONS, use_cache: bool = False):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.dimensions = dimensions
+        self.use_cache = use_cache
+
+    def __call__(self, input: Documents) -> Embeddings:
+        cache = _embedding_cache() if self.use_cache else None
+        keys = [EmbeddingCache.key(self.model_name, text) for text in input]
+        embeddings = cache.get_many(keys) if cache else {}
+
+        # Only texts that were never embedded before go to Ollama
+        missing = list({key: text for key, text in zip(keys, input) if key not in embeddings}.items())
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            fresh = list(zip(
+                [key for key, _ in batch],
+                self._embed_batch([text for _, text in batch])
+            ))
+            if cache:
+                cache.put_many(fresh)
+            embeddings.update(fresh)
+        if not keys:
+            return []
+
+        # Vectors are embedded and cached whole
+        vectors = np.asarray([embeddings[key] for key in keys], dtype=np.float32)
+        if self.dimensions < vectors.shape[1]:
+            # nomic's Matryoshka recipe: layer-norm the full vector, truncate, then
+            # re-normalise for cosine search
+            vectors -= vectors.mean(axis=1, keepdims=True)
+            vectors /= np.maximum(vectors.std(axis=1, keepdims=True), 1e-12)
+            vectors = vectors[:, :self.dimensions]
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors.tolist()
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        for attempt in range(EMBED_MAX_RETRIES):
+            response = post_json(OLLAMA_EMBED_URL, {"model": self.model_name, "input": texts})
+            if response.status_code not in (429, 503):
+                break
+            if attempt == EMBED_MAX_RETRIES - 1:
+                # Still overloaded; don't follow up with a request per text
+                response.raise_for_status()
+            # Ollama's request queue is full; back off with jitter so batches don't retry in step
+            time.sleep(2 ** attempt * 0.5 + random.uniform(0, 0.5))
+        if response.status_code == 200:
+            embeddings = orjson.loads(response.content).get("embeddings")
+            if embeddings:
+                return embeddings
+        elif response.status_code != 404:
+            response.raise_for_status()
+
+        # Older Ollama servers only offer the one-prompt-per-request endpoint
+        embeddings = []
+        for text in texts:
+            response = post_json(OLLAMA_LEGACY_EMBED_URL, {"model": self.model_name, "prompt": text})
+            response.raise_for_status()
+            embeddings.append(orjson.loads(response.content)["embedding"])
+        return embeddings
+
+
+# Embedding requests are I/O bound, so a few in flight keep Ollama busy
+_embed_pool = ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY, thread_name_prefix="embed")
+
+
+@functools.lru_cache(maxsize=1)
+def _open_collection():
+    """Return the shared Chroma collection handle.
+
+    Opening it means a round trip to Chroma's catalogue, so every processor
+    reuses the one handle instead of looking it up per request.
+    """
+    if CHROMA_HOST:
+        host, _, port = CHROMA_HOST.partition(":")
+        client = chromadb.HttpClient(host=host, port=int(port or CHROMA_DEFAULT_PORT))
+    else:
+        client = chromadb.PersistentClient(path="./demo-rag-chroma")
+    return client.get_or_create_collection(
+        name=COLLECTION_NAME,
+        embedding_function=OllamaBatchEmbeddingFunction(),
+        metadata={
+            "hnsw:space": "cosine",
+            "hnsw:batch_size": HNSW_BATCH_SIZE,
+            **configure_hnsw_params(0)
+        }
+    )
+
+
+class EmbeddingsProcessor:
+    def __init__(self, batch_size: int = UPSERT_BATCH_SIZE):
+        self.batch_size = min(max(batch_size, 50), 250)
+        self.collection = _open_collection()
+        # Chunk embeddings are cached; the collection's own function embeds queries
+        self.embedding_function = OllamaBatchEmbeddingFunction(use_cache=True)
+        self.encoder = _load_cross_encoder()
+        # Content hashes of PDFs that turned out to have no text
+        self._empty = set()
+
+    def process_pdf(self, pdf_path: str, sha256: str = None) -> Tuple[int, None]:
+        """Index a PDF page by page and return how many chunks it has.
+
+        Chunks are embedded a batch at a time as pages are read, so memory
+        stays bounded by the batch size rather than the document size.
+        """
+        sha256 = sha256 or _file_sha256(pdf_path)
+        # Ids derive from the path, file content and chunk text, so re-ingesting
+        # the same PDF is idempotent and another version never shares its chunks
+        prefix = hashlib.blake2b(f"{pdf_path}\0{sha256}".encode(), digest_size=8).hexdigest()
+        seen = set()
+        batch = []
+        indexed = 0
+        # Batches being embedded in the pool, oldest first; upserts stay in order
+        # on this thread while later batches are still being embedded
+        pending = deque()
+        # Split page by page so every chunk keeps its page metadata
+        for page_text, metadata in iter_pdf_pages(pdf_path):
+            for text in split_text(page_text):
+                digest = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+                chunk_id = f"{prefix}_{digest}"
+                if chunk_id in seen:
+                    continue
+                seen.add(chunk_id)
+                batch.append((chunk_id, text, {**metadata, "sha256": sha256}))
+                if len(batch) == self.batch_size:
+                    self._submit_batch(batch, pending)
+                    batch = []
+                    if len(pending) >= EMBED_CONCURRENCY:
+                        indexed += self._store_batch(*pending.popleft())
+        if batch:
+            self._submit_batch(batch, pending)
+        while pending:
+            indexed += self._store_batch(*pending.popleft())
+
+        if indexed:
+            logger.info("Indexed %d/%d new chunks from %s", indexed, len(seen), os.path.basename(pdf_path))
+            self._check_hnsw_tier()
         
-        documents, metadatas, ids = [], [], []
-        for idx, split in enumerate(splits):
-            documents.append(split.page_content)
-            metadatas.append(split.metadata)
-            ids.append(f"{os.path.basename(pdf_path)}_{idx}")
+        return len(seen), None
+
+    def _submit_batch(self, batch: List[Tuple[str, str, Dict]], pending: deque):
+        """Start embedding the chunks of a batch that are not already stored."""
+        ids = [chunk_id for chunk_id, _, _ in batch]
+        existing = set(self.collection.get(ids=ids, include=[])['ids'])
+        new = [chunk for chunk in batch if chunk[0] not in existing]
+        if new:
+            documents = [text for _, text, _ in new]
+            pending.append((new, _embed_pool.submit(self.embedding_function, documents)))
 
+    def _store_batch(self, new: List[Tuple[str, str, Dict]], embeddings) -> int:
         self.collection.upsert(
-            documents=documents,
-            metadatas=metadatas,
-            ids=ids
+            documents=[text for _, text, _ in new],
+            embeddings=embeddings.result(),
+            metadatas=[metadata for _, _, metadata in new],
+            ids=[chunk_id for chunk_id, _, _ in new]
         )
-        
-        return " ".join(documents), None
+        return len(new)
+
+    def _check_hnsw_tier(self):
+        """Warn once the collection outgrows the HNSW parameters it was built with.
+
+        The graph parameters are fixed at creation, so moving to a new tier means
+        rebuilding the collection (and re-embedding), which is left to the operator.
+        """
+        expected = configure_hnsw_params(self.collection.count())
+        current = self.collection.metadata or {}
+        if current.get("hnsw:M", 16) != expected["hnsw:M"]:  # Chroma's default M is 16
+            logger.warning(
+                f"Collection '{self.collection.name}' would benefit from HNSW parameters "
+                f"{expected}; rebuild it to apply them"
+            )
+
+    def index_pdf(self, pdf_path: str) -> Optional[str]:
+        """Index a PDF unless this same file was already indexed.
+
+        Returns the SHA256 of the indexed contents, or None when the PDF has no
+        text. The file is hashed on every call, since uploads reuse their temp
+        name and stat cannot tell a replaced file apart. The hash stored with
+        each chunk is then checked, so the same file is not parsed and embedded
+        again, even after a restart. Chunks of an earlier file at the same path
+        are dropped before the new contents are indexed.
+        """
+        sha256 = _file_sha256(pdf_path)
+        if sha256 in self._empty:
+            return None
+        stored = self.collection.get(
+            where={"$and": [{"sha256": sha256}, {"source": pdf_path}]},
+            limit=1,
+            include=[]
+        )
+        if not stored['ids']:
+            self.collection.delete(
+                where={"$and": [{"source": pdf_path}, {"sha256": {"$ne": sha256}}]}
+            )
+            chunk_count, _ = self.process_pdf(pdf_path, sha256)
+            if not chunk_count:
+                self._empty.add(sha256)
+                return None
+        return sha256
+
+    def query_similar_content(self, pdf_path: str, prompt: str, n_results: int = 3):
+        """Find the passages of a PDF most relevant to the prompt, indexing it first if needed."""
+        sha256 = self.index_pdf(pdf_path)
+        if not sha256:
+            logger.warning(f"No content extracted from {pdf_path}")
+            return None, False
 
-    def query_similar_content(self, query: str, prompt: str, n_results: int = 3):
-        """Query the vector store for similar content and validate relevance."""
         results = self.collection.query(
             query_texts=[prompt],
-            n_results=n_results
+            n_results=n_results,
+            where={"$and": [{"source": pdf_path}, {"sha256": sha256}]}
         )
         
         if not results['documents'][0]:
             return None, False
             
-        # Use the same re-ranking approach as app_doc_embed.py
-        encoder_model = CrossEncoder("cross-encoder/ms-marco-MiniLM-L-6-v2")
-        ranks = encoder_model.rank(prompt, results['documents'][0], top_k=3)
+        # Re-rank candidates with the cross-encoder, scoring all pairs in batches
+        candidates = results['documents'][0]
+        with torch.inference_mode():
+            scores = self.encoder.predict(
+                [(prompt, document) for document in candidates],
+                batch_size=RERANK_BATCH_SIZE,
+                convert_to_numpy=True
+            )
+        top = np.argsort(-scores)[:RERANK_TOP_K]
         
-        relevant_text = ""
-        for rank in ranks:
-            relevant_text += results['documents'][0][rank["corpus_id"]]
+        relevant_text = "\n\n".join([candidates[idx] for idx in top])
             
         # Check if we found any relevant content
         if not relevant_text:
@@ -1,36 +1,70 @@
 # models/doc_to_pdf.py
 
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from docx2pdf import convert
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
 
-def convert_docs_to_pdfs(folder_path, overwrite=False):
+def convert_docs_to_pdfs(folder_path, overwrite=False, on_converted=None):
     """
     Converts .doc and .docx files in the folder to PDFs.
     
     Args:
         folder_path (str): The path to the folder containing documents.
         overwrite (bool): If True, overwrites existing PDFs. Default is False.
+        on_converted (callable): Optional callback given each PDF path as soon as
+            its conversion finishes, e.g. EmbeddingsProcessor().process_pdf, so
+            indexing overlaps the conversions still running in the worker.
     """
     try:
-        files_converted = 0
-        for filename in os.listdir(folder_path):
+        # Collect pending conversions first so existing PDFs are never submitted
+        # One directory scan answers both "which docs" and "which PDFs exist",
+        # using DirEntry's cached type info instead of a stat per file
+        pending = []
+        with os.scandir(folder_path) as entries:
+            files = [entry for entry in entries if entry.is_file()]
+        existing = {entry.name.lower() for entry in files}
+        for entry in files:
+            filename = entry.name
             if filename.lower().endswith(('.doc', '.docx')):
-                doc_path = os.path.join(folder_path, filename)
+                doc_path = entry.path
                 pdf_path = os.path.splitext(doc_path)[0] + '.pdf'
+                pdf_name = os.path.basename(pdf_path).lower()
                 
-                if not overwrite and os.path.exists(pdf_path):
+                if not overwrite and pdf_name in existing:
                     logger.info(f"Skipped '{filename}' as PDF already exists.")
                     continue
-                
-                try:
-                    convert(doc_path, pdf_path)
-                    files_converted += 1
-                    logger.info(f"Converted '{filename}' to PDF.")
-                except Exception as file_error:
-                    logger.error(f"Failed to convert '{filename}': {file_error}")
+                pending.append((filename, doc_path, pdf_path))
+
+        files_converted = 0
+        if pending:
+            # docx2pdf drives the single running Word instance and quits it after
+            # each file, so conversions run one at a time in a worker process
+            # while this one handles on_converted. Word is kept open between
+            # files and quit after the last.
+            pdf_paths = {filename: pdf_path for filename, _, pdf_path in pending}
+            last = len(pending) - 1
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                futures = {
+                    executor.submit(convert, doc_path, pdf_path, keep_active=index < last): filename
+                    for index, (filename, doc_path, pdf_path) in enumerate(pending)
+                }
+                for future in as_completed(futures):
+                    filename = futures[future]
+                    try:
+                        future.result()
+                        files_converted += 1
+                        logger.info(f"Converted '{filename}' to PDF.")
+                    except Exception as file_error:
+                        logger.error(f"Failed to convert '{filename}': {file_error}")
+                        continue
+                    if on_converted:
+                        try:
+                            on_converted(pdf_paths[filename])
+                        except Exception as callback_error:
+                            logger.error(f"Failed to process '{filename}' after conversion: {callback_error}")
         
         if files_converted == 0:
             logger.warning("No files were converted. Check folder contents or overwrite setting.")
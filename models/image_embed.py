@@ -1,28 +1,29 @@
 import os
-import base64
+import pybase64
 import hashlib
-import json
+import mmap
+import orjson
 from pathlib import Path
 from typing import Optional, Dict
-import requests
+import io
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from PIL import Image
+from models.db_manager import MongoDBManager
+from utils.http_client import post_json
 
-class ImageEmbeddingProcessor:
-    def __init__(self, cache_dir: str = "./image_cache"):
-        self.cache_dir = Path(cache_dir)
-        self.cache_dir.mkdir(exist_ok=True)
-        self.ollama_url = "http://localhost:11434/api/generate"
-        self.embedding_url = "http://localhost:11434/api/embeddings"
-        self.cache_duration = timedelta(days=7)
+# Ollama tag of the vision model. The default tag is already 4-bit (Q4_K_M);
+# point this at another quantization, e.g. llama3.2-vision:11b-instruct-q8_0
+VISION_MODEL = os.getenv("VISION_MODEL", "llama3.2-vision")
 
-    def _get_image_hash(self, image_path: str) -> str:
-        """Generate unique hash for image file."""
-        image_stat = os.stat(image_path)
-        return hashlib.md5(f"{image_path}{image_stat.st_mtime}".encode()).hexdigest()
+# llama3.2-vision downscales to its vision tower input size anyway
+MAX_IMAGE_SIZE = (1120, 1120)
+WEBP_QUALITY = 85
+HASH_CHUNK_SIZE = 1024 * 1024  # 1 MB
+EMBEDDING_MODEL = "nomic-embed-text"
 
-    def _get_image_analysis(self, base64_image: str) -> Optional[str]:
-        """Get detailed image analysis using llama3.2-vision."""
-        detailed_prompt = """Analyze this image in extreme detail. Structure your analysis as follows:
+_ANALYSIS_PROMPT = """Analyze this image in extreme detail. Structure your analysis as follows:
 
 1. General Overview:
    - Main subject/focus
@@ -63,39 +64,123 @@ class ImageEmbeddingProcessor:
 
 Please be thorough and precise in your analysis, noting even minor details that might be relevant for future queries. Provide Response fast and accurate."""
 
+# Everything but the image is the same for every analysis request
+_ANALYSIS_PAYLOAD = {
+    "model": VISION_MODEL,
+    "prompt": _ANALYSIS_PROMPT,
+    "stream": False,
+    "options": {
+        "temperature": 0.2,  # Slightly increased for more natural language
+        "num_predict": 500   # Increased for more detailed response
+    }
+}
+
+# In-process tier in front of the JSON files; entries carry the base64 image,
+# so it stays small
+MEMORY_CACHE_SIZE = 64
+_memory_cache: "OrderedDict[str, Dict]" = OrderedDict()
+_memory_cache_lock = threading.Lock()
+
+
+def _memory_cache_get(image_hash: str) -> Optional[Dict]:
+    with _memory_cache_lock:
+        cache_data = _memory_cache.get(image_hash)
+        if cache_data is not None:
+            _memory_cache.move_to_end(image_hash)
+        return cache_data
+
+
+def _memory_cache_put(image_hash: str, cache_data: Dict):
+    with _memory_cache_lock:
+        _memory_cache[image_hash] = cache_data
+        _memory_cache.move_to_end(image_hash)
+        if len(_memory_cache) > MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def _hash_image_file(image_path: str) -> str:
+    with open(image_path, "rb") as image_file:
+        # file_digest (Python 3.11+) hashes in OpenSSL with the GIL released
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(image_file, "sha256").hexdigest()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: image_file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+
+def encode_file_base64(image_path: str) -> str:
+    """Base64 the file straight from the page cache instead of copying it into bytes."""
+    with open(image_path, "rb") as image_file:
         try:
-            response = requests.post(
+            with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return pybase64.b64encode_as_string(mapped)
+        except ValueError:  # Empty files cannot be mapped
+            return pybase64.b64encode_as_string(image_file.read())
+
+
+class ImageEmbeddingProcessor:
+    def __init__(self, cache_dir: str = "./image_cache", use_mongodb: bool = False):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(exist_ok=True)
+        self.db_manager = MongoDBManager() if use_mongodb else None
+        self.ollama_url = "http://localhost:11434/api/generate"
+        self.embedding_url = "http://localhost:11434/api/embed"
+        self.cache_duration = timedelta(days=7)
+
+    def _is_fresh(self, cache_data: Dict) -> bool:
+        cache_time = datetime.fromisoformat(cache_data['timestamp'])
+        return datetime.now() - cache_time < self.cache_duration
+
+    def _get_image_hash(self, image_path: str) -> str:
+        """Generate SHA256 of the image contents so duplicate uploads share a cache entry.
+
+        Hashed on every call: uploads reuse the same temp path, so neither
+        path nor stat can tell a replaced image from the one before it.
+        """
+        return _hash_image_file(image_path)
+
+    def _encode_image(self, image_path: str) -> str:
+        """Resize image to the model input size, re-encode it as WebP and base64 it."""
+        try:
+            with Image.open(image_path) as image:
+                if image.mode not in ("RGB", "RGBA"):
+                    image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+                image.thumbnail(MAX_IMAGE_SIZE, Image.LANCZOS)
+                buffer = io.BytesIO()
+                image.save(buffer, format="WEBP", quality=WEBP_QUALITY, method=6)
+                return pybase64.b64encode_as_string(buffer.getbuffer())
+        except Exception as e:
+            print(f"Error resizing image, sending original bytes: {e}")
+            return encode_file_base64(image_path)
+
+    def _get_image_analysis(self, base64_image: str) -> Optional[str]:
+        """Get detailed image analysis using llama3.2-vision."""
+        try:
+            response = post_json(
                 self.ollama_url,
-                json={
-                    "model": "llama3.2-vision",
-                    "prompt": detailed_prompt,
-                    "images": [base64_image],
-                    "options": {
-                        "temperature": 0.2,  # Slightly increased for more natural language
-                        "num_predict": 500   # Increased for more detailed response
-                    }
-                }
+                {**_ANALYSIS_PAYLOAD, "images": [base64_image]}
             )
             if response.status_code == 200:
-                return response.json().get('response', None)
+                return orjson.loads(response.content).get('response', None)
             return None
         except Exception as e:
             print(f"Error analyzing image: {e}")
             return None
 
-    def _get_image_embedding(self, base64_image: str) -> Optional[list]:
-        """Get embeddings using nomic-embed-text."""
+    def _get_text_embedding(self, text: str) -> Optional[list]:
+        """Embed the vision analysis with nomic-embed-text, a text-only model."""
         try:
-            response = requests.post(
+            response = post_json(
                 self.embedding_url,
-                json={
-                    "model": "nomic-embed-text",
-                    "prompt": "",
-                    "images": [base64_image]
+                {
+                    "model": EMBEDDING_MODEL,
+                    "input": [text]
                 }
             )
             if response.status_code == 200:
-                return response.json().get('embeddings', None)
+                embeddings = orjson.loads(response.content).get('embeddings')
+                return embeddings[0] if embeddings else None
             return None
         except Exception as e:
             print(f"Error getting embeddings: {e}")
@@ -107,20 +192,38 @@ Please be thorough and precise in your analysis, noting even minor details that
             image_hash = self._get_image_hash(image_path)
             cache_file = self.cache_dir / f"{image_hash}.json"
 
-            # Check cache
+            # Check the in-process cache, then the on-disk one
+            cache_data = _memory_cache_get(image_hash)
+            if cache_data and self._is_fresh(cache_data):
+                return cache_data
             if cache_file.exists():
-                cache_data = json.loads(cache_file.read_text())
-                cache_time = datetime.fromisoformat(cache_data['timestamp'])
-                if datetime.now() - cache_time < self.cache_duration:
+                cache_data = orjson.loads(cache_file.read_bytes())
+                if self._is_fresh(cache_data):
+                    _memory_cache_put(image_hash, cache_data)
+                    return cache_data
+
+            # Check MongoDB for an analysis of the same image content
+            if self.db_manager:
+                cached = self.db_manager.get_image_by_hash(image_hash)
+                if cached and cached.get('vision_analysis'):
+                    embeddings = cached.get('embeddings')
+                    cache_data = {
+                        'base64_image': cached['base64_image'],
+                        'vision_analysis': cached['vision_analysis'],
+                        'embeddings': embeddings.tolist() if embeddings is not None else None,
+                        'timestamp': datetime.now().isoformat(),
+                        'path': str(image_path)
+                    }
+                    cache_file.write_bytes(orjson.dumps(cache_data))
+                    _memory_cache_put(image_hash, cache_data)
                     return cache_data
 
-            # Read and encode image
-            with open(image_path, "rb") as image_file:
-                base64_image = base64.b64encode(image_file.read()).decode('utf-8')
+            # Downscale, re-encode and base64 the image
+            base64_image = self._encode_image(image_path)
 
-            # Get both analysis and embeddings
+            # Embed the analysis text; the embedding model cannot see the image itself
             vision_analysis = self._get_image_analysis(base64_image)
-            embeddings = self._get_image_embedding(base64_image)
+            embeddings = self._get_text_embedding(vision_analysis) if vision_analysis else None
 
             # Cache results
             cache_data = {
@@ -130,7 +233,12 @@ Please be thorough and precise in your analysis, noting even minor details that
                 'timestamp': datetime.now().isoformat(),
                 'path': str(image_path)
             }
-            cache_file.write_text(json.dumps(cache_data))
+            cache_file.write_bytes(orjson.dumps(cache_data))
+            _memory_cache_put(image_hash, cache_data)
+            if self.db_manager and vision_analysis:
+                self.db_manager.store_image_embeddings(
+                    image_path, {**cache_data, 'sha256': image_hash}
+                )
             return cache_data
 
         except Exception as e:
@@ -1,51 +1,168 @@
 import sys
 import os
 import time
-import requests
-import base64
-from typing import Optional
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import orjson
+from typing import Optional, List, Dict, Tuple, Iterator, Union
 from sentence_transformers import CrossEncoder  
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# Add the root directory to the sys.path (once, when run as a script)
+_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if _ROOT not in sys.path:
+    sys.path.append(_ROOT)
 from models.doc_embed import EmbeddingsProcessor 
-from models.image_embed import ImageEmbeddingProcessor
+from models.image_embed import ImageEmbeddingProcessor, VISION_MODEL, encode_file_base64
 import hashlib
 import io
-from pathlib import Path
 
-# Add the root directory to the sys.path
 from utils.logger import get_logger
+from utils.http_client import ollama_client, post_json, JSON_HEADERS
 # Logger setup
 logger = get_logger(__name__)
 
 OLLAMA_URL = "http://localhost:11434/api/generate"
-IMAGE_CACHE_DIR = Path("./image_cache")
-IMAGE_CACHE_DIR.mkdir(exist_ok=True)
+# Keep the model (and its KV cache) resident between turns of a session; Ollama
+# unloads it after this much idle time, which bounds memory on long-running servers
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# Ollama batches concurrent requests into one forward pass (up to its
+# OLLAMA_NUM_PARALLEL slots). Each generation blocks a thread for its whole
+# decode, so they get their own pool rather than queueing behind the small
+# default executor and reaching Ollama one after another.
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "32"))
+_generation_pool = ThreadPoolExecutor(max_workers=GENERATION_WORKERS, thread_name_prefix="ollama-generate")
+# Context window for every request. Ollama reloads the model (draining
+# in-flight requests) whenever num_ctx changes, so it is fixed, not per request.
+NUM_CTX = int(os.getenv("NUM_CTX", "8192"))
 
-def process_pdf(pdf_path: str) -> str:
-    """Extract text from a PDF using embeddings processor."""
-    try:
-        processor = EmbeddingsProcessor()
-        text_content, _ = processor.process_pdf(pdf_path)
-        return text_content
-    except Exception as e:
-        logger.error(f"Error processing PDF with embeddings: {str(e)}")
-        return ""
+_processor_lock = threading.Lock()
+
+def _get_embeddings_processor() -> EmbeddingsProcessor:
+    """Return the shared PDF embeddings processor, creating it on first use."""
+    with _processor_lock:
+        return _create_embeddings_processor()
+
+def _get_image_processor() -> ImageEmbeddingProcessor:
+    """Return the shared image processor, creating it on first use."""
+    with _processor_lock:
+        return _create_image_processor()
+
+@functools.lru_cache(maxsize=1)
+def _create_embeddings_processor() -> EmbeddingsProcessor:
+    return EmbeddingsProcessor()
+
+@functools.lru_cache(maxsize=1)
+def _create_image_processor() -> ImageEmbeddingProcessor:
+    return ImageEmbeddingProcessor(use_mongodb=True)
 
 def encode_image_to_base64(image_path: str) -> str:
-    """Get processed and cached image data."""
+    """Base64 the image file as-is, for when no processed image is available."""
     try:
-        processor = ImageEmbeddingProcessor()
-        result = processor.process_image(image_path)
-        if result and result.get('base64_image'):
-            return result['base64_image']
-        raise IOError("Failed to process image")
-    except IOError as e:
+        return encode_file_base64(image_path)
+    except OSError as e:
         logger.error(f"Image read error: {e}")
         raise
 
+def _tokens_needed(prompt: str, max_tokens: int, context: Optional[List[int]]) -> int:
+    """Estimate the tokens a turn occupies, at a rough four characters per token."""
+    return len(prompt) // 4 + len(context or ()) + max_tokens
+
+def _build_payload(
+    prompt: str,
+    model_name: str,
+    image_path: Optional[str],
+    pdf_path: Optional[str],
+    max_tokens: int,
+    temperature: float,
+    top_p: float,
+    top_k: int,
+    detailed_response: bool,
+    context: Optional[List[int]]
+) -> Tuple[Optional[Dict], Optional[str]]:
+    """Build the Ollama generate payload for a query.
+
+    Returns ``(payload, None)``, or ``(None, message)`` when the query can be
+    answered without calling the model (e.g. nothing relevant in the PDF).
+    """
+    # Each turn's context holds the whole conversation so far; once it would
+    # overflow num_ctx, start over rather than let Ollama truncate it silently.
+    # The context returned for this turn then replaces the stored one.
+    if context and _tokens_needed(prompt, max_tokens, context) > NUM_CTX:
+        logger.info("Session context reached %d tokens; starting a fresh one", len(context))
+        context = None
+
+    # A session's context is reset whenever a new file is attached, so a saved
+    # context already holds this file's analysis or passages (and image). Follow-up
+    # turns send only the new question instead of repeating them.
+    if context:
+        image_path = pdf_path = None
+
+    # Images come with a cached analysis from the vision model
+    image_data = _get_image_processor().process_image(image_path) if image_path else None
+
+    if image_data:
+        logger.info("Using cached image analysis and embeddings")
+        combined_prompt = f"""System: I have analyzed this image in detail. Here's the comprehensive analysis:
+
+{image_data['vision_analysis']}
+
+Based on this detailed analysis, please address the following user query:
+"{prompt}"
+
+Consider all relevant aspects from the analysis when forming your response. If the query asks about specific details, refer to the appropriate sections of the analysis."""
+    elif pdf_path:
+        processor = _get_embeddings_processor()
+        relevant_text, is_relevant = processor.query_similar_content(pdf_path, prompt)
+        
+        if not is_relevant:
+            return None, "I cannot find relevant information about this query in the provided document."
+        
+        detail_instruction = "Provide a comprehensive and detailed explanation with examples if available." if detailed_response else "Provide a brief and concise answer."
+        combined_prompt = f"""System: Answer based on the following context. {detail_instruction}
+        If the question cannot be answered from this context, say so.
+        
+        Context: {relevant_text}
+        
+        Question: {prompt}
+        
+        Remember to {'provide detailed explanations and examples' if detailed_response else 'keep the response concise'}."""
+    else:
+        detail_instruction = "provide comprehensive and detailed explanations" if detailed_response else "be brief and concise"
+        combined_prompt = f"System: Please {detail_instruction} in your response.\n\n{prompt}"
+
+    if _tokens_needed(combined_prompt, max_tokens, context) > NUM_CTX:
+        logger.warning("Prompt may exceed num_ctx (%d tokens); Ollama will truncate it", NUM_CTX)
+
+    # Prepare payload
+    payload = {
+        "model": model_name,
+        "prompt": combined_prompt,
+        "stream": False,
+        "options": {
+            "num_predict": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "top_k": top_k,
+            "num_ctx": NUM_CTX
+        }
+    }
+
+    if image_data:
+        payload["images"] = [image_data['base64_image']]
+    elif image_path:
+        # Fallback to basic image processing
+        payload["images"] = [encode_image_to_base64(image_path)]
+
+    payload["keep_alive"] = OLLAMA_KEEP_ALIVE
+    if context:
+        payload["context"] = context
+    return payload, None
+
 def generate_response(
     prompt: str,
-    model_name: str = "llama3.2-vision",
+    model_name: str = VISION_MODEL,
     image_path: Optional[str] = None,
     pdf_path: Optional[str] = None,
     max_tokens: int = 800,  # Increased max_tokens for detailed responses
@@ -53,103 +170,109 @@ def generate_response(
     top_p: float = 0.9,
     top_k: int = 40,
     detailed_response: bool = True,
-    system_prompt: str = "Carefully read the user prompt and provide a detailed response:"
-) -> str:
-    """Generate a response from the model using optional image or PDF input."""
-    try:
-        start_time = time.time()
-        
-        # Process PDF if provided
-        if pdf_path:
-            pdf_content = process_pdf(pdf_path)
-            if pdf_content:
-                processor = EmbeddingsProcessor()
-                relevant_text, is_relevant = processor.query_similar_content("", prompt)  # Empty query string as we're using prompt for search
-                
-                if not is_relevant:
-                    return "I cannot find relevant information about this query in the provided document."
-                
-                detail_instruction = "Provide a comprehensive and detailed explanation with examples if available." if detailed_response else "Provide a brief and concise answer."
-                combined_prompt = f"""System: Answer based on the following context. {detail_instruction}
-                If the question cannot be answered from this context, say so.
-                
-                Context: {relevant_text}
-                
-                Question: {prompt}
-                
-                Remember to {'provide detailed explanations and examples' if detailed_response else 'keep the response concise'}."""
-            else:
-                logger.warning("No content extracted from the PDF.")
-                return "Failed to extract content from the PDF."
-        else:
-            detail_instruction = "provide comprehensive and detailed explanations" if detailed_response else "be brief and concise"
-            combined_prompt = f"System: Please {detail_instruction} in your response.\n\n{prompt}"
-        
-        # Prepare payload
-        payload = {
-            "model": model_name,
-            "prompt": combined_prompt,
-            "stream": False,
-            "options": {
-                "num_predict": max_tokens,
-                "temperature": temperature,
-                "top_p": top_p,
-                "top_k": top_k
-            }
-        }
-
-        # Add image processing with vision model and embeddings
-        if image_path:
-            processor = ImageEmbeddingProcessor()
-            image_data = processor.process_image(image_path)
-            if image_data:
-                logger.info("Using cached image analysis and embeddings")
-                enhanced_prompt = f"""System: I have analyzed this image in detail. Here's the comprehensive analysis:
-
-{image_data['vision_analysis']}
+    system_prompt: str = "Carefully read the user prompt and provide a detailed response:",
+    context: Optional[List[int]] = None,
+    return_context: bool = False
+):
+    """Generate a response from the model using optional image or PDF input.
 
-Based on this detailed analysis, please address the following user query:
-"{prompt}"
-
-Consider all relevant aspects from the analysis when forming your response. If the query asks about specific details, refer to the appropriate sections of the analysis."""
+    Passing the ``context`` returned by a previous turn lets Ollama reuse the
+    already-evaluated tokens instead of re-prefilling the whole conversation.
+    With ``return_context=True`` a ``(response, context)`` tuple is returned.
+    """
+    def _result(text: str, new_context: Optional[List[int]] = None):
+        return (text, new_context) if return_context else text
 
-                payload = {
-                    "model": model_name,
-                    "prompt": enhanced_prompt,
-                    "images": [image_data['base64_image']],
-                    "stream": False,
-                    "options": {
-                        "num_predict": max_tokens,
-                        "temperature": temperature,
-                        "top_p": top_p,
-                        "top_k": top_k
-                    }
-                }
-                
-                if image_data.get('embeddings'):
-                    payload["embeddings"] = image_data['embeddings']
-            else:
-                # Fallback to basic image processing
-                payload["images"] = [encode_image_to_base64(image_path)]
+    try:
+        start_time = time.time()
+        payload, message = _build_payload(
+            prompt, model_name, image_path, pdf_path, max_tokens,
+            temperature, top_p, top_k, detailed_response, context
+        )
+        if payload is None:
+            return _result(message)
 
         # Send request to Ollama server
-        response = requests.post(OLLAMA_URL, json=payload)
+        response = post_json(OLLAMA_URL, payload)
         response_time = time.time() - start_time
 
         if response.status_code != 200:
             logger.error(f"API Error: {response.status_code} - {response.text}")
-            return "API request failed."
+            return _result("API request failed.")
 
-        logger.info(f"Response received in {response_time:.2f} seconds.")
-        response_data = response.json()
-        return response_data.get('response', 'No response content.')
+        logger.info("Response received in %.2f seconds.", response_time)
+        response_data = orjson.loads(response.content)
+        return _result(
+            response_data.get('response', 'No response content.'),
+            response_data.get('context')
+        )
 
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Request error: {e}")
-        return f"Request failed: {e}"
+        return _result(f"Request failed: {e}")
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
-        return f"An error occurred: {e}"
+        return _result(f"An error occurred: {e}")
+
+def stream_response(
+    prompt: str,
+    model_name: str = VISION_MODEL,
+    image_path: Optional[str] = None,
+    pdf_path: Optional[str] = None,
+    max_tokens: int = 800,
+    temperature: float = 0.7,
+    top_p: float = 0.9,
+    top_k: int = 40,
+    detailed_response: bool = True,
+    context: Optional[List[int]] = None
+) -> Iterator[Dict]:
+    """Yield response chunks from the model as they are generated.
+
+    Each chunk is one parsed line of Ollama's streamed output with the new
+    text under ``response``; the final chunk has ``done`` set and carries the
+    updated ``context``. Errors are reported as a single final chunk.
+    """
+    try:
+        payload, message = _build_payload(
+            prompt, model_name, image_path, pdf_path, max_tokens,
+            temperature, top_p, top_k, detailed_response, context
+        )
+        if payload is None:
+            yield {"response": message, "done": True}
+            return
+
+        payload["stream"] = True
+        with ollama_client.stream(
+            "POST", OLLAMA_URL, content=orjson.dumps(payload), headers=JSON_HEADERS
+        ) as response:
+            if response.status_code != 200:
+                response.read()
+                logger.error(f"API Error: {response.status_code} - {response.text}")
+                yield {"response": "API request failed.", "done": True}
+                return
+            for line in response.iter_lines():
+                if line:
+                    yield orjson.loads(line)
+
+    except httpx.HTTPError as e:
+        logger.error(f"Request error: {e}")
+        yield {"response": f"Request failed: {e}", "done": True}
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}")
+        yield {"response": f"An error occurred: {e}", "done": True}
+
+async def generate_response_async(
+    prompt: str, **kwargs
+) -> Union[str, Tuple[str, Optional[List[int]]]]:
+    """Async variant of generate_response that runs it in the generation pool.
+
+    Lets async handlers await model calls without blocking the event loop, so
+    concurrent requests reach Ollama together and can be batched there.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _generation_pool, functools.partial(generate_response, prompt, **kwargs)
+    )
 
 
 # Test script
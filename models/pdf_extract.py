@@ -0,0 +1,15 @@
+# models/pdf_extract.py
+
+# Worker-side PDF extraction. Kept apart from doc_embed so extraction processes
+# don't import torch, chromadb and the embedding pools themselves (the launching
+# script is still re-imported; see doc_embed._pdf_mp_context).
+
+import fitz  # PyMuPDF
+from typing import List
+
+
+def extract_page_range(pdf_path: str, start: int, stop: int) -> List[str]:
+    """Return the text of pages start..stop-1 of a PDF."""
+    # MuPDF documents cannot be shared across processes, so each worker opens its own
+    with fitz.open(pdf_path) as pdf:
+        return [pdf[number].get_text() for number in range(start, stop)]
@@ -1,14 +1,42 @@
-from models.model_loader import ensure_model_installed, generate_response
+import hashlib
+import json
+import os
+import time
+from models.model_loader import generate_response
+from models.image_embed import VISION_MODEL
 
-# Ensure the model is installed
-ensure_model_installed("llama3.2-vision")
+# Answers from earlier runs, so re-running the script skips identical model calls
+CACHE_DIR = ".llm_cache"
+CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+FAILED_RESPONSES = ("API request failed.", "Request failed:", "An error occurred:")
+
+def cached_generate_response(prompt, model_name=VISION_MODEL, image_path=None):
+    """generate_response with an on-disk cache keyed by model, prompt and image contents"""
+    image_hash = ""
+    if image_path:
+        with open(image_path, "rb") as image_file:
+            image_hash = hashlib.sha256(image_file.read()).hexdigest()
+    key = hashlib.sha256(f"{model_name}|{prompt}|{image_hash}".encode()).hexdigest()
+    cache_file = os.path.join(CACHE_DIR, f"{key}.json")
+
+    if os.path.exists(cache_file) and time.time() - os.path.getmtime(cache_file) < CACHE_TTL:
+        with open(cache_file) as f:
+            return json.load(f)["response"]
+
+    response = generate_response(prompt, model_name=model_name, image_path=image_path)
+    if response.startswith(FAILED_RESPONSES):
+        return response  # Don't replay a failed call on the next run
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(cache_file, "w") as f:
+        json.dump({"response": response}, f)
+    return response
 
 # Test with a simple prompt (text-only)
 prompt = "What is the capital of France?"
-response = generate_response("llama3.2-vision", prompt)
+response = cached_generate_response(prompt)
 print("Text-only Response:", response)
 
 # # Test with an image prompt (replace with a valid image path)
 # image_path = "landscape.jpg"  # Replace with your image file path
-# response_with_image = generate_response("llama3.2-vision", prompt, image_path)
+# response_with_image = cached_generate_response(prompt, image_path=image_path)
 # print("Image-based Response:", response_with_image)
@@ -0,0 +1,30 @@
+import atexit
+import httpx
+import orjson
+
+# Shared connection pool for every call to the local Ollama server, so
+# requests reuse keep-alive connections instead of reconnecting each time
+ollama_client = httpx.Client(
+    transport=httpx.HTTPTransport(
+        retries=3,  # Retry failed connection attempts
+        limits=httpx.Limits(
+            max_keepalive_connections=40,
+            max_connections=100,
+            keepalive_expiry=30
+        )
+    ),
+    timeout=httpx.Timeout(None, connect=5.0)  # Generation can take minutes
+)
+
+atexit.register(ollama_client.close)
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def post_json(url: str, payload: dict) -> httpx.Response:
+    """POST a payload to Ollama, encoding the body once with orjson.
+
+    Large base64 image strings are copied straight into the bytes body
+    instead of going through the stdlib JSON encoder.
+    """
+    return ollama_client.post(url, content=orjson.dumps(payload), headers=JSON_HEADERS)
@@ -1,18 +1,23 @@
 import logging
 import os
+from logging.handlers import MemoryHandler, RotatingFileHandler
 from datetime import datetime
 
-def get_logger(name):
-    """
-    Configures and returns a logger that writes logs to `log.txt` file and console.
-    Adds a separator line for each new execution.
+# Handlers shared by every logger, created on the first get_logger call
+_handlers = []
 
-    Args:
-        name (str): The name of the logger.
+def _shared_handlers():
+    """
+    Creates the log file and console handlers once per process.
+    Every logger writes through the same handlers, so there is a single open
+    file (and a single rotation) and the execution separator is written once.
 
     Returns:
-        logging.Logger: Configured logger instance.
+        list: The buffered file handler and the console handler.
     """
+    if _handlers:
+        return _handlers
+
     # Ensure the logs directory exists
     log_dir = "logs"
     os.makedirs(log_dir, exist_ok=True)
@@ -20,35 +25,59 @@ def get_logger(name):
     # File where logs will be saved
     log_file = os.path.join(log_dir, "log.txt")
 
-    # Create a logger
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)  # Log all levels (DEBUG and above)
-
     # Formatter for logs
     log_format = logging.Formatter(
         fmt="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S"
     )
 
-    # File handler (writes logs to a file)
-    file_handler = logging.FileHandler(log_file)
+    # File handler (writes logs to a file), buffered so records are written in
+    # batches instead of one syscall each; warnings and above flush right away
+    file_handler = RotatingFileHandler(log_file, maxBytes=10_000_000, backupCount=3)
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(log_format)
+    buffered_handler = MemoryHandler(
+        capacity=1000,
+        flushLevel=logging.WARNING,
+        target=file_handler
+    )
+    buffered_handler.setLevel(logging.DEBUG)
 
     # Console handler (prints logs to the console)
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)  # Show INFO level logs in the console
     console_handler.setFormatter(log_format)
 
-    # Add handlers to the logger
-    if not logger.hasHandlers():  # Avoid duplicate handlers
-        logger.addHandler(file_handler)
-        logger.addHandler(console_handler)
-
-    # Add a separator line for each new execution
+    # Add a separator line for each new execution through the already-open file
     separator = f"\n{'=' * 50}\n=== Execution: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ===\n{'=' * 50}\n"
-    with open(log_file, "a") as f:
-        f.write(separator)
+    file_handler.stream.write(separator)
+    file_handler.flush()
+
+    _handlers.extend([buffered_handler, console_handler])
+    return _handlers
+
+def get_logger(name):
+    """
+    Configures and returns a logger that writes logs to `log.txt` file and console.
+    Adds a separator line for each new execution.
+
+    Args:
+        name (str): The name of the logger.
+
+    Returns:
+        logging.Logger: Configured logger instance.
+    """
+    # Create a logger
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)  # Log all levels (DEBUG and above)
+
+    # Skip handler setup if this logger is already configured
+    if logger.hasHandlers():
+        return logger
+
+    # Add handlers to the logger
+    for handler in _shared_handlers():
+        logger.addHandler(handler)
 
     return logger
 